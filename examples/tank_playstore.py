@@ -1,4 +1,22 @@
+"""
+Toolkit Tank PlayStore Descriptor.
+
+Play store credentials retrieved from the client site are cached on disk, in
+plain text, for up to 24 hours, in a file only readable by the current user
+in the global toolkit cache. This is the same trust level as the session
+tokens tk-core caches in that location. Cached credentials are checked with
+a play store request before they are used. The cache saves the credentials
+request to the site when a process first connects to the play store. Set
+the SGTK_DISABLE_PLAY_STORE_CREDENTIALS_CACHE environment variable to 1 to
+disable the cache, which also removes previously cached credentials.
+"""
+
 import os
+import ssl
+import time
+import socket
+import hashlib
+import threading
 from tank_vendor.six.moves import urllib
 from tank_vendor.six.moves import http_client
 from tank_vendor.shotgun_api3.lib import httplib2
@@ -8,6 +26,8 @@ from tank.descriptor import InvalidAppStoreCredentialsError
 from tank.descriptor import TankAppStoreError
 
 from tank import LogManager
+from tank.util import filesystem
+from tank.util import LocalFileStorageManager
 
 from tank.constants import SUPPORT_EMAIL
 
@@ -17,10 +37,164 @@ from tank_vendor import six
 
 json = shotgun_api3.shotgun.json
 
-from playstore_io_descriptor import IODescriptorPlayStoreBase
+try:
+    # orjson decodes considerably faster than the json module and accepts
+    # the raw response bytes, use it when the interpreter provides it.
+    import orjson as fast_json
+except ImportError:
+    fast_json = json
+
+from playstore_io_descriptor import IODescriptorPlayStoreBase, log_timing
 
 log = LogManager.get_logger(__name__)
 
+# number of seconds play store credentials cached on disk remain valid
+CREDENTIALS_CACHE_MAX_AGE = 24 * 60 * 60
+
+# credentials endpoint urls, keyed by site url
+_credentials_urls = {}
+
+# keep-alive http connections used to retrieve play store credentials,
+# keyed by site url and http proxy
+_credentials_connections = {}
+
+
+def _get_credentials_url(sg_url):
+    """
+    Returns the url of the endpoint providing the play store credentials of a site.
+
+    :param sg_url: Url of the client shotgun site
+    :returns: Url string
+    """
+    try:
+        return _credentials_urls[sg_url]
+    except KeyError:
+        url = _credentials_urls[sg_url] = "%s/api3/sgtk_install_script" % sg_url.rstrip("/")
+        return url
+
+
+def _get_credentials_connection(sg, timeout):
+    """
+    Returns the http connection to use to retrieve the play store credentials
+    of a site. It has the proxy and certificate settings of the site's shotgun
+    API connection, but an explicit timeout, since the site connection has none
+    by default. The connection is kept alive and reused for the site.
+
+    :param sg: Shotgun API instance connected to the client site
+    :param timeout: Timeout in seconds of the requests
+    :returns: httplib2.Http instance
+    """
+    key = (sg.base_url, sg.config.raw_http_proxy)
+    http = _credentials_connections.get(key)
+    if http is None:
+        site_http = sg._get_connection()
+        http = _credentials_connections[key] = httplib2.Http(
+            timeout=timeout,
+            ca_certs=site_http.ca_certs,
+            proxy_info=site_http.proxy_info,
+            disable_ssl_certificate_validation=site_http.disable_ssl_certificate_validation,
+        )
+    return http
+
+
+def _discard_credentials_connection(sg):
+    """
+    Closes and forgets the http connection used to retrieve the play store
+    credentials of a site, so that the next request opens a new one.
+
+    :param sg: Shotgun API instance connected to the client site
+    """
+    http = _credentials_connections.pop((sg.base_url, sg.config.raw_http_proxy), None)
+    if http is not None:
+        for connection in http.connections.values():
+            connection.close()
+
+
+def _get_credentials_cache_path(sg_url):
+    """
+    Returns the path to the file where play store credentials are cached
+    for the given site.
+
+    :param sg_url: Url of the client shotgun site
+    :returns: Path to a json file
+    """
+    cache_root = LocalFileStorageManager.get_global_root(LocalFileStorageManager.CACHE)
+    return os.path.join(
+        cache_root,
+        "play_store_credentials",
+        "%s.json" % hashlib.sha1(six.ensure_binary(sg_url)).hexdigest(),
+    )
+
+
+def _load_cached_credentials(sg_url):
+    """
+    Loads the play store credentials cached on disk for the given site.
+
+    :param sg_url: Url of the client shotgun site
+    :returns: Dictionary with keys script_name, script_key and script_user
+              or None if no valid cache entry exists.
+    """
+    cache_file = _get_credentials_cache_path(sg_url)
+    try:
+        with open(cache_file, "r") as fh:
+            data = json.load(fh)
+        timestamp = data["timestamp"]
+        script_name = data["script_name"]
+        script_key = data["script_key"]
+        script_user = data["script_user"]
+    except Exception as e:
+        log.debug("No cached play store credentials in %s: %s" % (cache_file, e))
+        return None
+
+    if time.time() - timestamp > CREDENTIALS_CACHE_MAX_AGE:
+        log.debug("Cached play store credentials in %s have expired." % cache_file)
+        return None
+
+    return {
+        "script_name": script_name,
+        "script_key": script_key,
+        "script_user": script_user,
+    }
+
+
+def _clear_cached_credentials(sg_url):
+    """
+    Removes the play store credentials cached on disk for the given site.
+
+    :param sg_url: Url of the client shotgun site
+    """
+    cache_file = _get_credentials_cache_path(sg_url)
+    try:
+        os.remove(cache_file)
+    except OSError:
+        pass
+
+
+def _store_cached_credentials(sg_url, script_name, script_key, script_user):
+    """
+    Caches play store credentials on disk for the given site. The file
+    is only readable by the current user. Failures are logged and ignored.
+
+    :param sg_url: Url of the client shotgun site
+    :param script_name: Play store script name
+    :param script_key: Play store script key
+    :param script_user: Play store ApiUser entity dictionary
+    """
+    cache_file = _get_credentials_cache_path(sg_url)
+    data = {
+        "timestamp": time.time(),
+        "script_name": script_name,
+        "script_key": script_key,
+        "script_user": {"type": script_user["type"], "id": script_user["id"]},
+    }
+    try:
+        filesystem.ensure_folder_exists(os.path.dirname(cache_file))
+        fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as fh:
+            json.dump(data, fh)
+    except Exception as e:
+        log.debug("Could not cache play store credentials in %s: %s" % (cache_file, e))
+
 
 class IODescriptorTankPlayStore(IODescriptorPlayStoreBase):
     CORE_VERSION_ENTITY_TYPE = "CustomNonProjectEntity01"
@@ -66,7 +240,13 @@ class IODescriptorTankPlayStore(IODescriptorPlayStoreBase):
     # The address of your PlayStore site
     SGTK_PLAY_STORE = "https://tank.shotgunstudio.com"
 
-    @LogManager.log_timing
+    # An environment variable to disable caching play store credentials on disk
+    DISABLE_CREDENTIALS_CACHE_ENV_VAR = "SGTK_DISABLE_PLAY_STORE_CREDENTIALS_CACHE"
+
+    # locks ensuring only one thread connects to the play store for a given site
+    _play_store_connection_locks = {}
+
+    @log_timing
     def _create_sg_play_store_connection(self):
         """
         Creates a shotgun connection that can be used to access the Toolkit play store.
@@ -80,100 +260,214 @@ class IODescriptorTankPlayStore(IODescriptorPlayStoreBase):
         # 1:1 relationship between play store accounts
         # and shotgun sites.
 
-        if os.environ.get(self.DISABLE_PLAYSTORE_ACCESS_ENV_VAR, "0") == "1":
-            message = (
+        # this runs for every remote operation on hosts which permanently disable
+        # access, so raise straight away and let callers decide whether to log.
+        if self._is_play_store_access_disabled():
+            raise TankAppStoreConnectionError(
                 "The '%s' environment variable is active, preventing connection to play store."
                 % self.DISABLE_PLAYSTORE_ACCESS_ENV_VAR
             )
-            log.debug(message)
-            raise TankAppStoreConnectionError(message)
 
         sg_url = self._sg_connection.base_url
 
         if sg_url not in self._play_store_connections:
+            # only one thread goes through the slow path, others wait and reuse its result.
+            # dict.setdefault is atomic so concurrent callers always get the same lock.
+            lock = self._play_store_connection_locks.setdefault(sg_url, threading.Lock())
+            with lock:
+                if sg_url in self._play_store_connections:
+                    return self._play_store_connections[sg_url]
+
+                # credentials cached on disk by a previous process let us skip the
+                # credentials request to the site.
+                connection = self._create_play_store_connection_from_cache()
+                if connection is None:
+                    connection = self._create_play_store_connection_from_site()
+
+                self._play_store_connections[sg_url] = connection
+
+        return self._play_store_connections[sg_url]
+
+    def _create_play_store_connection_from_cache(self):
+        """
+        Connects to the play store with the credentials cached on disk for the
+        client site. The credentials are checked with a lookup of the cached
+        script user, and removed from the cache if they have been revoked or
+        rotated since they were cached.
+
+        :returns: (sg, dict) where the first item is the shotgun api instance and the second
+                  is an sg entity dictionary (keys type/id) corresponding to to the user used
+                  to connect to the play store, or None if no valid credentials are cached.
+        """
+        sg_url = self._sg_connection.base_url
 
-            # Connect to associated Shotgun site and retrieve the credentials to use to
-            # connect to the play store site
-            try:
+        if self._is_credentials_cache_disabled():
+            return None
+
+        cached = _load_cached_credentials(sg_url)
+        if not cached:
+            return None
+
+        log.debug("Using play store credentials cached on disk for %s" % sg_url)
+        play_store_sg = self._connect_to_play_store(
+            cached["script_name"], cached["script_key"]
+        )
+        try:
+            script_user = self._find_play_store_user(
+                play_store_sg, [["id", "is", cached["script_user"]["id"]]]
+            )
+        except InvalidAppStoreCredentialsError:
+            script_user = None
+
+        if script_user is None:
+            log.debug("Play store credentials cached for %s are no longer valid." % sg_url)
+            _clear_cached_credentials(sg_url)
+            return None
+
+        return (play_store_sg, script_user)
+
+    def _create_play_store_connection_from_site(self):
+        """
+        Retrieves the play store credentials from the client site, connects
+        to the play store and resolves the script user to use.
+
+        :returns: (sg, dict) where the first item is the shotgun api instance and the second
+                  is an sg entity dictionary (keys type/id) corresponding to to the user used
+                  to connect to the play store.
+        """
+        sg_url = self._sg_connection.base_url
+
+        # Connect to associated Shotgun site and retrieve the credentials to use to
+        # connect to the play store site
+        try:
+            (script_name, script_key) = self._get_play_store_key_from_shotgun()
+        except urllib.error.HTTPError as e:
+            if e.code == 403:
+                # edge case alert!
+                # this is likely because our session token in shotgun has expired.
+                # The authentication system is based around wrapping the shotgun API,
+                # and requesting authentication if needed. Because the play store
+                # credentials is a separate endpoint and doesn't go via the shotgun
+                # API, we have to explicitly check.
+                #
+                # trigger a refresh of our session token by issuing a shotgun API call
+                self._sg_connection.find_one("HumanUser", [])
+                # and retry
                 (script_name, script_key) = self._get_play_store_key_from_shotgun()
-            except urllib.error.HTTPError as e:
-                if e.code == 403:
-                    # edge case alert!
-                    # this is likely because our session token in shotgun has expired.
-                    # The authentication system is based around wrapping the shotgun API,
-                    # and requesting authentication if needed. Because the play store
-                    # credentials is a separate endpoint and doesn't go via the shotgun
-                    # API, we have to explicitly check.
-                    #
-                    # trigger a refresh of our session token by issuing a shotgun API call
-                    self._sg_connection.find_one("HumanUser", [])
-                    # and retry
-                    (script_name, script_key) = self._get_play_store_key_from_shotgun()
-                else:
-                    raise
-
-            log.debug("Connecting to %s..." % self.SGTK_PLAY_STORE)
-            # Connect to the play store and resolve the script user id we are connecting with.
-            # Set the timeout explicitly so we ensure the connection won't hang in cases where
-            # a response is not returned in a reasonable amount of time.
-            play_store_sg = shotgun_api3.Shotgun(
-                self.SGTK_PLAY_STORE,
-                script_name=script_name,
-                api_key=script_key,
-                http_proxy=self._get_play_store_proxy_setting(),
-                connect=False,
+            else:
+                raise
+
+        play_store_sg = self._connect_to_play_store(script_name, script_key)
+
+        # determine the script user running currently
+        # get the API script user ID from shotgun
+        script_user = self._find_play_store_user(
+            play_store_sg, [["firstname", "is", script_name]]
+        )
+
+        if script_user is None:
+            raise TankAppStoreError(
+                "Could not evaluate the current PlayStore User! Please contact support."
             )
-            # set the default timeout for play store connections
-            play_store_sg.config.timeout_secs = self.SGTK_PLAY_STORE_CONN_TIMEOUT
-
-            # determine the script user running currently
-            # get the API script user ID from shotgun
-            try:
-                script_user = play_store_sg.find_one(
-                    "ApiUser",
-                    filters=[["firstname", "is", script_name]],
-                    fields=["type", "id"],
-                )
-            except shotgun_api3.AuthenticationFault:
-                raise InvalidAppStoreCredentialsError(
-                    "The Toolkit PlayStore credentials found in Shotgun are invalid.\n"
-                    "Please contact %s to resolve this issue." % SUPPORT_EMAIL
+
+        if self._is_credentials_cache_disabled():
+            _clear_cached_credentials(sg_url)
+        else:
+            _store_cached_credentials(sg_url, script_name, script_key, script_user)
+
+        return (play_store_sg, script_user)
+
+    def _find_play_store_user(self, play_store_sg, filters):
+        """
+        Looks up the ApiUser used to connect to the play store.
+
+        :param play_store_sg: Shotgun api instance connected to the play store
+        :param filters: Filters identifying the ApiUser entity
+        :returns: sg entity dictionary (keys type/id) or None if not found
+        :raises InvalidAppStoreCredentialsError: If the play store rejects the credentials
+        :raises TankAppStoreConnectionError: If the play store can't be reached
+        """
+        try:
+            return play_store_sg.find_one("ApiUser", filters=filters, fields=["type", "id"])
+        except shotgun_api3.AuthenticationFault:
+            raise InvalidAppStoreCredentialsError(
+                "The Toolkit PlayStore credentials found in Shotgun are invalid.\n"
+                "Please contact %s to resolve this issue." % SUPPORT_EMAIL
+            )
+        # Connection errors can occur for a variety of reasons. For example, there is no
+        # internet access or there is a proxy server blocking access to the Toolkit play store.
+        except (
+            httplib2.HttpLib2Error,
+            httplib2.socks.HTTPError,
+            http_client.HTTPException,
+        ) as e:
+            raise TankAppStoreConnectionError(e)
+        # In cases where there is a firewall/proxy blocking access to the play store, sometimes
+        # the firewall will drop the connection instead of rejecting it. The API request will
+        # timeout which unfortunately results in a generic SSLError with only the message text
+        # to give us a clue why the request failed.
+        # The exception raised in this case is "ssl.SSLError: The read operation timed out"
+        except (socket.timeout, ssl.SSLError) as e:
+            if isinstance(e, socket.timeout) or "timed out" in str(e).lower():
+                raise TankAppStoreConnectionError(
+                    "Connection to %s timed out: %s"
+                    % (play_store_sg.config.server, e)
                 )
-            # Connection errors can occur for a variety of reasons. For example, there is no
-            # internet access or there is a proxy server blocking access to the Toolkit play store.
-            except (
-                httplib2.HttpLib2Error,
-                httplib2.socks.HTTPError,
-                http_client.HTTPException,
-            ) as e:
-                raise TankAppStoreConnectionError(e)
-            # In cases where there is a firewall/proxy blocking access to the play store, sometimes
-            # the firewall will drop the connection instead of rejecting it. The API request will
-            # timeout which unfortunately results in a generic SSLError with only the message text
-            # to give us a clue why the request failed.
-            # The exception raised in this case is "ssl.SSLError: The read operation timed out"
-            except httplib2.ssl.SSLError as e:
-                if "timed" in e.message:
-                    raise TankAppStoreConnectionError(
-                        "Connection to %s timed out: %s"
-                        % (play_store_sg.config.server, e)
-                    )
-                else:
-                    # other type of ssl error
-                    raise TankAppStoreError(e)
-            except Exception as e:
+            else:
+                # other type of ssl error
                 raise TankAppStoreError(e)
+        except Exception as e:
+            raise TankAppStoreError(e)
 
-            if script_user is None:
-                raise TankAppStoreError(
-                    "Could not evaluate the current PlayStore User! Please contact support."
-                )
+    def _has_play_store_credentials(self):
+        """
+        Tells whether credentials to connect to the play store have already
+        been established for the client site, in this process or by a previous
+        one which cached them on disk.
 
-            self._play_store_connections[sg_url] = (play_store_sg, script_user)
+        :returns: True if credentials are established, False otherwise
+        """
+        if super(IODescriptorTankPlayStore, self)._has_play_store_credentials():
+            return True
+        if self._is_credentials_cache_disabled():
+            return False
+        return _load_cached_credentials(self._sg_connection.base_url) is not None
 
-        return self._play_store_connections[sg_url]
+    def _is_credentials_cache_disabled(self):
+        """
+        Checks if caching play store credentials on disk has been disabled via
+        the environment.
 
-    @LogManager.log_timing
+        :returns: True if the cache is disabled, False otherwise
+        """
+        return os.environ.get(self.DISABLE_CREDENTIALS_CACHE_ENV_VAR) == "1"
+
+    def _connect_to_play_store(self, script_name, script_key):
+        """
+        Creates a shotgun api instance for the play store. No network
+        request is made by this method.
+
+        :param script_name: Play store script name
+        :param script_key: Play store script key
+        :returns: Shotgun api instance
+        """
+        log.debug("Connecting to %s..." % self.SGTK_PLAY_STORE)
+        # Connect to the play store and resolve the script user id we are connecting with.
+        # Set the timeout explicitly so we ensure the connection won't hang in cases where
+        # a response is not returned in a reasonable amount of time.
+        play_store_sg = shotgun_api3.Shotgun(
+            self.SGTK_PLAY_STORE,
+            script_name=script_name,
+            api_key=script_key,
+            http_proxy=self._get_play_store_proxy_setting(),
+            connect=False,
+        )
+        # set the default timeout for play store connections
+        play_store_sg.config.timeout_secs = self.SGTK_PLAY_STORE_CONN_TIMEOUT
+
+        return play_store_sg
+
+    @log_timing
     def _get_play_store_key_from_shotgun(self):
         """
         Given a Shotgun url and script credentials, fetch the play store key
@@ -185,29 +479,58 @@ class IODescriptorTankPlayStore(IODescriptorPlayStoreBase):
 
         log.debug("Retrieving play store credentials from %s" % sg.base_url)
 
-        # handle proxy setup by pulling the proxy details from the main shotgun connection
-        if sg.config.proxy_handler:
-            opener = urllib.request.build_opener(sg.config.proxy_handler)
-            urllib.request.install_opener(opener)
-
         # now connect to our site and use a special url to retrieve the play store script key
         session_token = sg.get_session_token()
-        post_data = {"session_token": session_token}
-        response = urllib.request.urlopen(
-            "%s/api3/sgtk_install_script" % sg.base_url,
-            six.ensure_binary(urllib.parse.urlencode(post_data)),
-        )
-        html = response.read()
-        data = json.loads(html)
+        post_data = b"session_token=" + urllib.parse.quote_plus(session_token).encode("ascii")
+        url = _get_credentials_url(sg.base_url)
+
+        # a hung site or proxy must not block forever, so the request goes through a
+        # connection with an explicit timeout, kept alive for the 403 retry and later
+        # credentials requests to the site.
+        http = _get_credentials_connection(sg, self.SGTK_PLAY_STORE_CONN_TIMEOUT)
+        try:
+            (response, html) = http.request(
+                url,
+                "POST",
+                body=post_data,
+                headers={"content-type": "application/x-www-form-urlencoded"},
+            )
+        except (
+            socket.timeout,
+            socket.error,
+            httplib2.HttpLib2Error,
+            http_client.HTTPException,
+        ) as e:
+            # don't leave a broken socket behind for the next credentials request
+            _discard_credentials_connection(sg)
+            raise TankAppStoreConnectionError(
+                "Could not retrieve play store credentials from %s: %s" % (sg.base_url, e)
+            )
+        if response.status != 200:
+            # surface errors the same way urllib does so that callers can
+            # detect an expired session token (403) and retry.
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response, None
+            )
+
+        try:
+            data = fast_json.loads(html)
+            script_name = data["script_name"]
+            script_key = data["script_key"]
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidAppStoreCredentialsError(
+                "Unexpected Toolkit PlayStore credentials response from Shotgun: %s\n"
+                "Please contact %s to resolve this issue." % (e, SUPPORT_EMAIL)
+            )
 
-        if not data["script_name"] or not data["script_key"]:
+        if not script_name or not script_key:
             raise InvalidAppStoreCredentialsError(
                 "Toolkit PlayStore credentials could not be retrieved from Shotgun.\n"
                 "Please contact %s to resolve this issue." % SUPPORT_EMAIL
             )
 
         log.debug(
-            "Retrieved play store credentials for account '%s'." % data["script_name"]
+            "Retrieved play store credentials for account '%s'." % script_name
         )
 
-        return data["script_name"], data["script_key"]
\ No newline at end of file
+        return script_name, script_key
\ No newline at end of file
@@ -1 +1 @@
-from .playstore import IODescriptorPlayStoreBase
\ No newline at end of file
+from .playstore import IODescriptorPlayStoreBase, log_timing
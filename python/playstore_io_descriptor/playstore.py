@@ -13,7 +13,14 @@ Toolkit PlayStore Descriptor.
 """
 
 import os
+import re
+import time
+import socket
+import datetime
 import fnmatch
+import logging
+import functools
+from multiprocessing.pool import ThreadPool
 
 from tank.util import shotgun
 from tank.util import pickle
@@ -23,19 +30,183 @@ from tank.descriptor import TankAppStoreError
 from tank.descriptor import TankDescriptorError
 
 from tank import LogManager
+from tank.constants import PROFILING_LOG_CHANNEL
 from tank.descriptor import constants
 from tank.descriptor.io_descriptor.downloadable import IODescriptorDownloadable
 
 # use api json to cover py 2.5
 from tank_vendor import shotgun_api3
+from tank_vendor import six
+from tank_vendor.six.moves import urllib
 
 json = shotgun_api3.shotgun.json
 
+try:
+    # orjson decodes considerably faster than the json module, use it to
+    # read the metadata cache when the interpreter provides it.
+    from orjson import loads as _parse_metadata
+except ImportError:
+    _parse_metadata = json.loads
+
+
+def _dump_metadata(metadata):
+    """
+    Serializes metadata for the cache file. Always uses the json module, so that
+    interpreters sharing a bundle cache, with or without orjson, write identical
+    files for identical metadata.
+
+    :param metadata: metadata dictionary
+    :returns: bytes
+    """
+    return six.ensure_binary(
+        json.dumps(
+            metadata,
+            default=_serialize_metadata_value,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+    )
+
+
+def _serialize_metadata_value(value):
+    """
+    Converts a metadata value json can't represent to a string,
+    using the ISO 8601 format for dates and times.
+
+    :param value: value to convert
+    :returns: str
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _dump_legacy_metadata(metadata):
+    """
+    Serializes metadata for the legacy pickle cache file, using the pickle
+    protocol of tk-core so that Python 2 and 3 can both read it.
+
+    :param metadata: metadata dictionary
+    :returns: bytes
+    """
+    return six.ensure_binary(pickle.dumps(metadata))
+
+
 log = LogManager.get_logger(__name__)
 
 
 # file where we cache the app store metadata for an item
-METADATA_FILE = ".cached_metadata.pickle"
+METADATA_FILE = ".cached_metadata.json"
+
+# file where the app store metadata used to be cached. It is still updated where
+# it exists, for older releases of the descriptor sharing the same bundle cache.
+LEGACY_METADATA_FILE = ".cached_metadata.pickle"
+
+# appended to a bundle path to get the path of its metadata cache files,
+# equivalent to os.path.join for paths without a trailing separator
+_METADATA_SUFFIX = os.sep + METADATA_FILE
+_LEGACY_METADATA_SUFFIX = os.sep + LEGACY_METADATA_FILE
+
+# display names of the bundle types
+DISPLAY_NAME_LOOKUP = {
+    constants.DESCRIPTOR_APP: "App",
+    constants.DESCRIPTOR_FRAMEWORK: "Framework",
+    constants.DESCRIPTOR_ENGINE: "Engine",
+    constants.DESCRIPTOR_CONFIG: "Config",
+    constants.DESCRIPTOR_CORE: "Core",
+}
+
+# number of versions retrieved at a time when looking for the latest labelled version
+LABEL_SEARCH_PAGE_SIZE = 50
+
+# number of seconds during which the result of a remote access probe is reused
+REMOTE_ACCESS_PROBE_MAX_AGE = 30
+
+# number of attempts made by a remote access probe of the play store host
+REMOTE_ACCESS_PROBE_ATTEMPTS = 2
+
+# maximum number of threads used to load metadata cache files
+METADATA_LOAD_THREADS = 8
+
+# compiled regular expressions for the glob style tags matched against labels
+_tag_patterns = {}
+
+# values of the environment variables read so far, see IODescriptorPlayStoreBase.refresh_env
+_env_cache = {}
+
+# (timestamp, deep, result) of the last remote access probes, keyed
+# by play store and client site, see IODescriptorPlayStoreBase.has_remote_access
+_remote_access_probes = {}
+
+try:
+    # errors raised when a connection is dropped, refused or times out. Other socket
+    # errors, e.g. certificate verification failures, are permanent.
+    _CONNECTION_ERRORS = (socket.timeout, ConnectionError)
+except NameError:
+    # python 2 doesn't tell connection errors apart from other socket errors
+    _CONNECTION_ERRORS = (socket.timeout,)
+
+# marker for missing values, where None is a meaningful value
+_UNSET = object()
+
+
+def _get_env(name):
+    """
+    Returns the value of an environment variable. The environment is only
+    read the first time a given variable is requested.
+
+    :param name: Name of the environment variable
+    :returns: The value of the variable or None if it is not set
+    """
+    try:
+        return _env_cache[name]
+    except KeyError:
+        value = _env_cache[name] = os.environ.get(name)
+        return value
+
+
+def log_timing(func):
+    """
+    Decorator timing the decorated function like :meth:`LogManager.log_timing`,
+    but only while the profiling log channel has debug logging enabled. Otherwise
+    the function is called directly, without any timing or logging overhead.
+
+    :param func: Function to decorate
+    :returns: Decorated function
+    """
+    timed_func = LogManager.log_timing(func)
+    timing_log = logging.getLogger("%s.%s" % (PROFILING_LOG_CHANNEL, func.__module__))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if timing_log.isEnabledFor(logging.DEBUG):
+            return timed_func(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _per_class_property(func):
+    """
+    Decorator turning a method computing a value from class attributes into
+    a read-only property evaluated only once per class. Subclasses overriding
+    those attributes get their own value.
+
+    :param func: Method to decorate
+    :returns: property
+    """
+    values = {}
+
+    @functools.wraps(func)
+    def getter(self):
+        cls = self.__class__
+        try:
+            return values[cls]
+        except KeyError:
+            value = values[cls] = func(self)
+            return value
+
+    return property(getter)
 
 
 class IODescriptorPlayStoreBase(IODescriptorDownloadable):
@@ -48,6 +219,13 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
     # cache play store connections for performance
     _play_store_connections = {}
 
+    # play store proxy settings, keyed by play store, proxy setting name and client site
+    _play_store_proxies = {}
+
+    # metadata loaded from disk, keyed by cache file path. Values are
+    # (file signature, metadata) tuples, see _get_file_signature.
+    _metadata_cache = {}
+
     # The entity representing tk-core
     CORE_VERSION_ENTITY_TYPE = "CustomNonProjectEntity01"
     # The EventLog event type to emit when downloading tk-core
@@ -106,9 +284,15 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
     SGTK_PLAY_STORE = "https://yoursite.shotgunstudio.com"
     # Timeout in secs to apply to TK play store connections
     SGTK_PLAY_STORE_CONN_TIMEOUT = 5
+    # Number of attempts made for play store requests failing with transient errors
+    SGTK_PLAY_STORE_MAX_ATTEMPTS = 3
+    # An environment variable overriding the number of attempts made for play store requests
+    PLAY_STORE_MAX_ATTEMPTS_ENV_VAR = "SGTK_PLAY_STORE_MAX_ATTEMPTS"
+    # Delay in secs before the first retry of a play store request, grows with each attempt
+    SGTK_PLAY_STORE_RETRY_DELAY = 0.75
 
 
-    @property
+    @_per_class_property
     def playstore_entity_mapping(self):
         return {
             constants.DESCRIPTOR_APP: self.APP_ENTITY_TYPE,
@@ -118,8 +302,8 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             constants.DESCRIPTOR_INSTALLED_CONFIG: None,
             constants.DESCRIPTOR_CORE: None,
         }
-    
-    @property
+
+    @_per_class_property
     def playstore_version_entity_mapping(self):
         return {
             constants.DESCRIPTOR_APP: self.APP_VERSION_ENTITY_TYPE,
@@ -130,7 +314,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             constants.DESCRIPTOR_CORE: self.CORE_VERSION_ENTITY_TYPE,
         }
 
-    @property
+    @_per_class_property
     def playstore_link_field_mapping(self):
         return {
             constants.DESCRIPTOR_APP: self.APP_LINK_FIELD,
@@ -141,7 +325,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             constants.DESCRIPTOR_CORE: None,
         }
 
-    @property
+    @_per_class_property
     def playstore_download_event_mapping(self):
         return {
             constants.DESCRIPTOR_APP: self.APP_DOWNLOAD_EVENT_TYPE,
@@ -152,9 +336,9 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             constants.DESCRIPTOR_CORE: self.CORE_DOWNLOAD_EVENT_TYPE,
         }
 
-    @property
+    @_per_class_property
     def version_fields_to_cache(self):
-        return [
+        return (
             "id",
             "code",
             "sg_status_list",
@@ -163,16 +347,16 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             "sg_detailed_release_notes",
             "sg_documentation",
             self.TANK_CODE_PAYLOAD_FIELD,
-        ]
+        )
 
-    @property
+    @_per_class_property
     def bundle_fields_to_cache(self):
-        return [
-        "id",
-        "sg_system_name",
-        "sg_status_list",
-        "sg_deprecation_message",
-    ]
+        return (
+            "id",
+            "sg_system_name",
+            "sg_status_list",
+            "sg_deprecation_message",
+        )
 
     def __init__(self, descriptor_dict, sg_connection, bundle_type):
         """
@@ -195,26 +379,21 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         self._name = descriptor_dict.get("name")
         self._version = descriptor_dict.get("version")
         self._label = descriptor_dict.get("label")
+        # cache paths only depend on the cache roots, see set_cache_roots
+        self._cache_paths = None
+        self._bundle_cache_paths = {}
 
     def __str__(self):
         """
         Human readable representation
         """
-        display_name_lookup = {
-            constants.DESCRIPTOR_APP: "App",
-            constants.DESCRIPTOR_FRAMEWORK: "Framework",
-            constants.DESCRIPTOR_ENGINE: "Engine",
-            constants.DESCRIPTOR_CONFIG: "Config",
-            constants.DESCRIPTOR_CORE: "Core",
-        }
-
         # Toolkit PlayStore App tk-multi-loader2 v1.2.3
         # Toolkit PlayStore Framework tk-framework-shotgunutils v1.2.3
         # Toolkit PlayStore Core v1.2.3
         if self._bundle_type == constants.DESCRIPTOR_CORE:
             display_name = "Toolkit PlayStore Core %s" % self._version
         else:
-            display_name = display_name_lookup[self._bundle_type]
+            display_name = DISPLAY_NAME_LOOKUP[self._bundle_type]
             display_name = "Toolkit PlayStore %s %s %s" % (
                 display_name,
                 self._name,
@@ -226,38 +405,244 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
 
         return display_name
 
+    @classmethod
+    def refresh_env(cls):
+        """
+        Discards the environment variable values read so far so that
+        changes made to the environment are picked up.
+        """
+        _env_cache.clear()
+
+    def _is_play_store_access_disabled(self):
+        """
+        Checks if access to the play store has been disabled via the environment.
+
+        :returns: True if access is disabled, False otherwise
+        """
+        return _get_env(self.DISABLE_PLAYSTORE_ACCESS_ENV_VAR) == "1"
+
     def _create_sg_play_store_connection(self):
         """
         Creates a shotgun connection that can be used to access the Toolkit play store.
+        This is called before every remote operation, implementations should therefore
+        cache the connection in :attr:`_play_store_connections`, keyed by client site,
+        and return the cached connection on subsequent calls. Reusing the same shotgun
+        api instance keeps its http connection alive between requests. The instance should
+        be created with ``connect=False`` and have its timeout set to
+        :attr:`SGTK_PLAY_STORE_CONN_TIMEOUT` before it is used.
         :returns: (sg, dict) where the first item is the shotgun api instance and the second
                   is an sg entity dictionary (keys type/id) corresponding to to the user used
                   to connect to the play store.
         """
         raise NotImplementedError
 
-    def _load_cached_play_store_metadata(self, path):
+    def _discard_sg_play_store_connection(self):
+        """
+        Discards the play store connection cached for the client site,
+        so that the next remote operation connects again. The last remote
+        access probe for the site is discarded as well, since it may have
+        reported access through that connection.
+        """
+        self._play_store_connections.pop(self._sg_connection.base_url, None)
+        _remote_access_probes.pop(self._get_remote_access_probe_key(), None)
+
+    def _get_remote_access_probe_key(self):
+        """
+        Returns the key of the remote access probes of this descriptor in
+        the probe results shared by all descriptors.
+        :returns: (play store url, client site url) tuple
+        """
+        return (self.SGTK_PLAY_STORE, self._sg_connection.base_url)
+
+    def _sg_call(self, method, *args, **kwargs):
+        """
+        Calls a method of a play store shotgun connection. Requests failing
+        because of a dropped connection, a timeout or a 503 http error are
+        retried, waiting a little longer before each attempt. The shotgun api
+        already retries 502 and 504 errors as well as ssl errors itself.
+        Only use this for requests which can safely be sent twice.
+        :param method: Shotgun api method to call, e.g. sg.find
+        :param args: Positional arguments to pass to the method
+        :param kwargs: Keyword arguments to pass to the method
+        :returns: The value returned by the method
+        """
+        try:
+            max_attempts = int(_get_env(self.PLAY_STORE_MAX_ATTEMPTS_ENV_VAR))
+        except (TypeError, ValueError):
+            max_attempts = self.SGTK_PLAY_STORE_MAX_ATTEMPTS
+
+        attempt = 1
+        while True:
+            try:
+                return method(*args, **kwargs)
+            except shotgun_api3.AuthenticationFault:
+                # the credentials were revoked or rotated, the next
+                # remote operation should connect with new ones.
+                self._discard_sg_play_store_connection()
+                raise
+            except (shotgun_api3.ProtocolError,) + _CONNECTION_ERRORS as e:
+                if attempt >= max_attempts:
+                    raise
+                if isinstance(e, shotgun_api3.ProtocolError) and e.errcode != 503:
+                    raise
+                delay = self.SGTK_PLAY_STORE_RETRY_DELAY * attempt
+                log.debug(
+                    "Play store request failed, attempt %d of %d. Retrying in %.2f seconds: %s"
+                    % (attempt, max_attempts, delay, e)
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def _load_cached_play_store_metadata(self, path, cache_file=None):
         """
         Loads the metadata for a path in the play store
         :param path: path to bundle location on disk
+        :param cache_file: path to the metadata file in the bundle location,
+                           computed from path if not specified
         :return: metadata dictionary or None if not found
         """
-        cache_file = os.path.join(path, METADATA_FILE)
-        if os.path.exists(cache_file):
-            fp = open(cache_file, "rb")
-            try:
-                metadata = pickle.load(fp)
-            finally:
-                fp.close()
-        else:
+        if cache_file is None:
+            cache_file = path + _METADATA_SUFFIX
+        metadata = self._read_metadata_file(cache_file, _parse_metadata)
+        if metadata is not None:
+            return metadata
+
+        # fall back on metadata only cached in the legacy format, e.g. by an
+        # older release of the descriptor, and add the missing file.
+        legacy_cache_file = path + _LEGACY_METADATA_SUFFIX
+        metadata = self._read_metadata_file(legacy_cache_file, pickle.loads)
+        if metadata is None:
             log.debug(
                 "%r Could not find cached metadata file %s - "
                 "will proceed with empty play store metadata." % (self, cache_file)
             )
-            metadata = {}
+            return {}
+
+        log.debug("Migrating play store metadata cache '%s'" % legacy_cache_file)
+        self._write_metadata_file(cache_file, metadata, _dump_metadata)
+        return metadata
+
+    def _read_metadata_file(self, cache_file, parse):
+        """
+        Reads a metadata cache file, reusing the metadata already
+        loaded by this process if the file hasn't been modified since.
+        :param cache_file: path to the metadata cache file
+        :param parse: function turning the file contents into a dictionary
+        :return: metadata dictionary or None if the file doesn't exist
+        """
+        signature = self._get_file_signature(cache_file)
+        if signature is None:
+            return None
+
+        cached = self._metadata_cache.get(cache_file)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        # read the file in one go rather than letting the parser issue many small reads
+        fp = open(cache_file, "rb")
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        metadata = parse(data)
 
+        self._metadata_cache[cache_file] = (signature, metadata)
         return metadata
 
-    @LogManager.log_timing
+    def _write_metadata_file(self, cache_file, metadata, dump):
+        """
+        Writes a metadata cache file. The file may be located in a read-only
+        bundle cache, in which case the failure is logged and ignored.
+        :param cache_file: path to the metadata cache file
+        :param metadata: metadata dictionary to write
+        :param dump: function turning the metadata dictionary into the file contents
+        """
+        try:
+            data = dump(metadata)
+            # leave the file untouched if it already holds this metadata,
+            # its modification time is part of its signature.
+            try:
+                fp = open(cache_file, "rb")
+                try:
+                    unchanged = fp.read() == data
+                finally:
+                    fp.close()
+            except (IOError, OSError):
+                unchanged = False
+
+            if unchanged:
+                log.debug("Play store metadata cache '%s' is up to date" % cache_file)
+            else:
+                fp = open(cache_file, "wb")
+                try:
+                    fp.write(data)
+                    log.debug("Wrote play store metadata cache '%s'" % cache_file)
+                finally:
+                    fp.close()
+            # spare the next accessor from reading back what we just wrote
+            self._metadata_cache[cache_file] = (
+                self._get_file_signature(cache_file),
+                metadata,
+            )
+        except Exception as e:
+            log.debug(
+                "Did not update play store metadata cache '%s': %s" % (cache_file, e)
+            )
+
+    def _load_cached_play_store_metadata_for_paths(self, paths):
+        """
+        Loads the metadata for several paths in the play store. When several
+        cache files haven't been loaded by this process yet, they are read
+        concurrently so that file system latency overlaps.
+        :param paths: paths to bundle locations on disk
+        :return: dictionary keyed by path, with the metadata dictionary for
+                 each path or the exception raised while loading it.
+        """
+
+        load_metadata = self._load_cached_play_store_metadata
+
+        def load(path_and_cache_file):
+            try:
+                return load_metadata(*path_and_cache_file)
+            except Exception as e:
+                return e
+
+        paths = list(paths)
+        paths_and_cache_files = [(path, path + _METADATA_SUFFIX) for path in paths]
+        metadata_cache = self._metadata_cache
+        not_in_memory = [
+            cache_file
+            for (_, cache_file) in paths_and_cache_files
+            if cache_file not in metadata_cache
+        ]
+
+        if len(not_in_memory) > 1:
+            pool = ThreadPool(min(METADATA_LOAD_THREADS, len(not_in_memory)))
+            try:
+                results = pool.map(load, paths_and_cache_files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [load(x) for x in paths_and_cache_files]
+
+        return dict(zip(paths, results))
+
+    @staticmethod
+    def _get_file_signature(path):
+        """
+        Returns a value identifying the current contents of a file,
+        made of its modification time and size.
+        :param path: path to the file
+        :return: signature tuple or None if the file doesn't exist
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size)
+
+    @log_timing
     def _refresh_metadata(self, path, sg_bundle_data=None, sg_version_data=None):
         """
         Refreshes the metadata cache on disk. The metadata cache contains
@@ -274,7 +659,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         """
         log.debug("Attempting to refresh play store metadata for %r" % self)
 
-        cache_file = os.path.join(path, METADATA_FILE)
+        cache_file = path + _METADATA_SUFFIX
         log.debug("Will attempt to refresh cache in %s" % cache_file)
 
         if (
@@ -296,7 +681,8 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
                 # special handling of core since it doesn't have a high-level 'bundle' entity
                 sg_bundle_data = None
 
-                sg_version_data = sg.find_one(
+                sg_version_data = self._sg_call(
+                    sg.find_one,
                     self.CORE_VERSION_ENTITY_TYPE,
                     [["code", "is", self._version]],
                     self.version_fields_to_cache,
@@ -309,30 +695,54 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             else:
                 # engines, apps etc have a 'bundle level entity' in the play store,
                 # e.g. something representing the app or engine.
-                # then a version entity representing a particular version
-                sg_bundle_data = sg.find_one(
-                    bundle_entity_type,
-                    [["sg_system_name", "is", self._name]],
-                    self.bundle_fields_to_cache,
-                )
-
-                if sg_bundle_data is None:
-                    raise TankDescriptorError(
-                        "The Play Store does not contain an item named '%s'!"
-                        % self._name
+                # then a version entity representing a particular version.
+                # Retrieve both in a single query, filtering versions on the
+                # system name of the bundle they are linked to.
+                try:
+                    sg_version_data = self._sg_call(
+                        sg.find_one,
+                        version_entity_type,
+                        [
+                            [self._get_linked_bundle_field("sg_system_name"), "is", self._name],
+                            ["code", "is", self._version],
+                        ],
+                        list(self.version_fields_to_cache)
+                        + self._get_linked_bundle_fields(),
+                    )
+                except shotgun_api3.Fault as e:
+                    log.debug("Could not retrieve bundle and version data at once: %s" % e)
+                    sg_version_data = None
+
+                if sg_version_data:
+                    sg_bundle_data = self._pop_linked_bundle_data(sg_version_data)
+                else:
+                    # either nothing matched or the query was rejected. Query the bundle
+                    # and the version separately to report precisely what is missing.
+                    sg_bundle_data = self._sg_call(
+                        sg.find_one,
+                        bundle_entity_type,
+                        [["sg_system_name", "is", self._name]],
+                        self.bundle_fields_to_cache,
                     )
 
-                # now get the version
-                sg_version_data = sg.find_one(
-                    version_entity_type,
-                    [[link_field, "is", sg_bundle_data], ["code", "is", self._version]],
-                    self.version_fields_to_cache,
-                )
-                if sg_version_data is None:
-                    raise TankDescriptorError(
-                        "The Play Store does not have a "
-                        "version '%s' of item '%s'!" % (self._version, self._name)
+                    if sg_bundle_data is None:
+                        raise TankDescriptorError(
+                            "The Play Store does not contain an item named '%s'!"
+                            % self._name
+                        )
+
+                    # now get the version
+                    sg_version_data = self._sg_call(
+                        sg.find_one,
+                        version_entity_type,
+                        [[link_field, "is", sg_bundle_data], ["code", "is", self._version]],
+                        self.version_fields_to_cache,
                     )
+                    if sg_version_data is None:
+                        raise TankDescriptorError(
+                            "The Play Store does not have a "
+                            "version '%s' of item '%s'!" % (self._version, self._name)
+                        )
 
         # create metadata
         metadata = {
@@ -342,21 +752,88 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
 
         # try to write to location - but it may be located in a
         # readonly bundle cache - if the caching fails, gracefully
-        # fall back and log
-        try:
-            fp = open(cache_file, "wb")
-            try:
-                pickle.dump(metadata, fp)
-                log.debug("Wrote play store metadata cache '%s'" % cache_file)
-            finally:
-                fp.close()
-        except Exception as e:
-            log.debug(
-                "Did not update play store metadata cache '%s': %s" % (cache_file, e)
+        # fall back and log. Where an older release of the descriptor sharing
+        # the bundle cache wrote the legacy file, it is kept up to date for it.
+        self._write_metadata_file(cache_file, metadata, _dump_metadata)
+        legacy_cache_file = path + _LEGACY_METADATA_SUFFIX
+        if os.path.exists(legacy_cache_file):
+            self._write_metadata_file(
+                legacy_cache_file, metadata, _dump_legacy_metadata
             )
 
         return metadata
 
+    @log_timing
+    def _refresh_metadata_batch(self, path_by_version):
+        """
+        Refreshes the metadata cache on disk for several versions of this
+        descriptor's bundle, retrieving the metadata for all of them from
+        the play store in a single query.
+        Versions which can't be found in the play store are skipped.
+        :param path_by_version: dictionary mapping version numbers to the path
+                                of the bundle where cache info should be written
+        :returns: dictionary keyed by path, with the metadata dictionary
+                  written for each path.
+        """
+        log.debug(
+            "Retrieving play store metadata for %d versions of %r"
+            % (len(path_by_version), self)
+        )
+
+        (sg, _) = self._create_sg_play_store_connection()
+
+        (sg_bundle_data, sg_versions) = self._find_versions(
+            sg,
+            [["code", "in", list(path_by_version.keys())]],
+            list(self.version_fields_to_cache),
+        )
+
+        metadata_by_path = {}
+        for sg_version_data in sg_versions:
+            path = path_by_version.get(sg_version_data["code"])
+            if path and path not in metadata_by_path:
+                metadata_by_path[path] = self._refresh_metadata(
+                    path, sg_bundle_data, sg_version_data
+                )
+        return metadata_by_path
+
+    def _get_linked_bundle_field(self, field):
+        """
+        Returns the deep field path to a field of the bundle entity
+        linked to a version entity of this descriptor's type, e.g.
+        sg_tank_app.CustomNonProjectEntity02.sg_system_name
+        :param field: field on the bundle entity
+        :returns: field path to use in queries on the version entity
+        """
+        return "%s.%s.%s" % (
+            self.playstore_link_field_mapping[self._bundle_type],
+            self.playstore_entity_mapping[self._bundle_type],
+            field,
+        )
+
+    def _get_linked_bundle_fields(self):
+        """
+        Returns the deep field paths to request on a version entity
+        in order to retrieve the bundle data to cache alongside it.
+        :returns: list of field paths
+        """
+        return [self._get_linked_bundle_field(f) for f in self.bundle_fields_to_cache]
+
+    def _pop_linked_bundle_data(self, sg_version_data):
+        """
+        Removes the linked bundle fields from a version record retrieved
+        with :meth:`_get_linked_bundle_fields` and returns them as a
+        bundle entity dictionary.
+        :param sg_version_data: version entity dictionary, modified in place
+        :returns: bundle entity dictionary
+        """
+        sg_bundle_data = {"type": self.playstore_entity_mapping[self._bundle_type]}
+        for field in self.bundle_fields_to_cache:
+            sg_bundle_data[field] = sg_version_data.pop(
+                self._get_linked_bundle_field(field), None
+            )
+        return sg_bundle_data
+
     def _get_bundle_cache_path(self, bundle_cache_root):
         """
         Given a cache root, compute a cache path suitable
@@ -364,9 +841,13 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         :param bundle_cache_root: Bundle cache root path
         :return: Path to bundle cache location
         """
-        return os.path.join(
-            bundle_cache_root, self.PLAY_STORE_DISK_NAME, self.get_system_name(), self.get_version()
-        )
+        path = self._bundle_cache_paths.get(bundle_cache_root)
+        if path is None:
+            path = os.path.join(
+                bundle_cache_root, self.PLAY_STORE_DISK_NAME, self.get_system_name(), self.get_version()
+            )
+            self._bundle_cache_paths[bundle_cache_root] = path
+        return path
 
     def _get_cache_paths(self):
         """
@@ -375,6 +856,10 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         Note: This method only computes paths and does not perform any I/O ops.
         :return: List of path strings
         """
+        if self._cache_paths is not None:
+            # return a copy so callers can't alter the cached list
+            return list(self._cache_paths)
+
         # get default cache paths from base class
         paths = super(IODescriptorPlayStoreBase, self)._get_cache_paths()
 
@@ -397,7 +882,21 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         if legacy_folder:
             paths.append(legacy_folder)
 
-        return paths
+        self._cache_paths = paths
+        return list(paths)
+
+    def set_cache_roots(self, primary_root, fallback_roots):
+        """
+        Specify where to go look for cached versions of the app.
+        Clears the cache paths computed for the previous roots.
+        :param primary_root: Path for installing bundles
+        :param fallback_roots: List of paths where bundles may already exist
+        """
+        super(IODescriptorPlayStoreBase, self).set_cache_roots(
+            primary_root, fallback_roots
+        )
+        self._cache_paths = None
+        self._bundle_cache_paths = {}
 
     ###############################################################################################
     # data accessors
@@ -497,11 +996,13 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             # connect to the play store
             (sg, script_user) = self._create_sg_play_store_connection()
 
-            # fetch metadata from sg...
-            metadata = self._refresh_metadata(download_path)
-
-            # now get the attachment info
+            # the metadata was cached to disk by _download_local, only
+            # fetch it from sg again if it can't be found there.
+            metadata = self._load_cached_play_store_metadata(download_path)
             version = metadata.get("sg_version_data")
+            if not version:
+                metadata = self._refresh_metadata(download_path)
+                version = metadata.get("sg_version_data")
 
             # setup the data entry
             data = {}
@@ -516,7 +1017,8 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             data["project"] = self.EVENTLOG_PROJECT
             data["attribute_name"] = self.TANK_CODE_PAYLOAD_FIELD
 
-            # log the data to shotgun
+            # log the data to shotgun. Not retried, a request timing out
+            # may still have created the entry.
             sg.create("EventLogEntry", data)
         except Exception as e:
             log.warning("Could not write play store download receipt: %s" % e)
@@ -544,12 +1046,43 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             # the sought-after label
             version_numbers = []
             log.debug("culling out versions not labelled '%s'..." % self._label)
+            metadata_by_path = self._load_cached_play_store_metadata_for_paths(
+                all_versions.values()
+            )
+
+            # versions without usable metadata, e.g. if the cache file was removed,
+            # are refreshed from the play store all at once. This is the fallback
+            # used when working offline, so only do so when a connection to the play
+            # store already exists and was found to work recently, never probe here.
+            missing = dict(
+                (version_str, path)
+                for (version_str, path) in all_versions.items()
+                if isinstance(metadata_by_path[path], Exception)
+                or not metadata_by_path[path].get("sg_version_data")
+            )
+            if (
+                missing
+                and self._has_play_store_credentials()
+                and self._has_recent_remote_access()
+            ):
+                try:
+                    metadata_by_path.update(self._refresh_metadata_batch(missing))
+                except Exception as e:
+                    log.debug(
+                        "Could not refresh missing play store metadata for %r: %s"
+                        % (self, e)
+                    )
+            # local bindings, this loop runs for every cached version
+            match_label = self._match_label
+            add_version = version_numbers.append
             for (version_str, path) in all_versions.items():
-                metadata = self._load_cached_play_store_metadata(path)
+                metadata = metadata_by_path[path]
                 try:
+                    if isinstance(metadata, Exception):
+                        raise metadata
                     tags = [x["name"] for x in metadata["sg_version_data"]["tags"]]
-                    if self._match_label(tags):
-                        version_numbers.append(version_str)
+                    if match_label(tags):
+                        add_version(version_str)
                 except Exception as e:
                     log.debug(
                         "Could not determine label metadata for %s. Ignoring. Details: %s"
@@ -588,7 +1121,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         log.debug("Latest cached version resolved to %r" % desc)
         return desc
 
-    @LogManager.log_timing
+    @log_timing
     def get_latest_version(self, constraint_pattern=None):
         """
         Returns a descriptor object that represents the latest version.
@@ -610,7 +1143,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         (sg, _) = self._create_sg_play_store_connection()
 
         # get latest get the filter logic for what to exclude
-        if self.PLAY_STORE_QA_MODE_ENV_VAR in os.environ:
+        if _get_env(self.PLAY_STORE_QA_MODE_ENV_VAR) is not None:
             sg_filter = [["sg_status_list", "is_not", "bad"]]
         else:
             sg_filter = [
@@ -618,54 +1151,54 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
                 ["sg_status_list", "is_not", "bad"],
             ]
 
-        if self._bundle_type != self.CORE:
-            # find the main entry
-            sg_bundle_data = sg.find_one(
-                self.playstore_entity_mapping[self._bundle_type],
-                [["sg_system_name", "is", self._name]],
-                self.bundle_fields_to_cache,
-            )
-
-            if sg_bundle_data is None:
-                raise TankDescriptorError(
-                    "Play Store does not contain an item named '%s'!" % self._name
-                )
-
-            # now get all versions
-            link_field = self.playstore_link_field_mapping[self._bundle_type]
-            entity_type = self.playstore_version_entity_mapping[self._bundle_type]
-            sg_filter += [[link_field, "is", sg_bundle_data]]
-
-        else:
-            # core doesn't have a parent entity for its versions
-            sg_bundle_data = None
-            entity_type = self.CORE_VERSION_ENTITY_TYPE
-
         # optimization: if there is no constraint pattern and no label
         # set, just download the latest record
+        paged = False
         if self._label is None and constraint_pattern is None:
             # only download one record
             limit = 1
+        elif constraint_pattern is None:
+            # only the latest record matching the label is needed. Tags are globs
+            # so the label can't be matched by the query, download records page by
+            # page instead, stopping at the first page with a match.
+            limit = LABEL_SEARCH_PAGE_SIZE
+            paged = True
         else:
             limit = 0  # all records
 
-        # now get all versions
-        sg_versions = sg.find(
-            entity_type,
-            filters=sg_filter,
-            fields=self.version_fields_to_cache,
-            order=[{"field_name": "created_at", "direction": "desc"}],
-            limit=limit,
-        )
-
-        log.debug("Downloaded data for %d versions from Shotgun." % len(sg_versions))
+        if limit == 1:
+            fields = self.version_fields_to_cache
+        else:
+            # only request what is needed to pick a version, the payload field
+            # in particular is sizeable and would be sent for every version.
+            fields = ["id", "code", "tags"]
 
-        # now filter out all labels that aren't matching
         matching_records = []
-        for sg_version_entry in sg_versions:
-            tags = [x["name"] for x in sg_version_entry["tags"]]
-            if self._match_label(tags):
-                matching_records.append(sg_version_entry)
+        # latest matching record for each version number
+        matching_by_code = {}
+        page = 1 if paged else 0
+        while True:
+            # now get all versions
+            (sg_bundle_data, sg_versions) = self._find_versions(
+                sg, sg_filter, fields, limit=limit, page=page
+            )
+
+            log.debug(
+                "Downloaded data for %d versions from Shotgun." % len(sg_versions)
+            )
+
+            # now filter out all labels that aren't matching
+            for sg_version_entry in sg_versions:
+                tags = [x["name"] for x in sg_version_entry["tags"]]
+                if self._match_label(tags):
+                    matching_records.append(sg_version_entry)
+                    matching_by_code.setdefault(
+                        sg_version_entry["code"], sg_version_entry
+                    )
+
+            if not paged or matching_records or len(sg_versions) < limit:
+                break
+            page += 1
 
         log.debug(
             "After applying label filters, %d records remain." % len(matching_records)
@@ -694,9 +1227,7 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
                     )
                 )
             # get the sg data for the given version
-            sg_data_for_version = [
-                d for d in matching_records if d["code"] == version_to_use
-            ][0]
+            sg_data_for_version = matching_by_code[version_to_use]
 
         else:
             # no constraints applied. Pick first (latest) match
@@ -724,10 +1255,101 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         # are correctly cached locally.
         cached_path = desc.get_path()
         if cached_path:
+            if fields != self.version_fields_to_cache:
+                # get all the fields to cache for the chosen version
+                sg_data_for_version = self._sg_call(
+                    sg.find_one,
+                    self.playstore_version_entity_mapping[self._bundle_type],
+                    [["id", "is", sg_data_for_version["id"]]],
+                    self.version_fields_to_cache,
+                )
             desc._refresh_metadata(cached_path, sg_bundle_data, sg_data_for_version)
 
         return desc
 
+    def _find_versions(self, sg, filters, fields, limit=0, page=0):
+        """
+        Finds the versions of this descriptor's bundle matching the given filters,
+        latest first. Except for core, which doesn't have a bundle entity, the data
+        of the bundle the versions belong to is retrieved in the same query.
+        :param sg: Play store shotgun connection
+        :param filters: Filters to apply to the version entities
+        :param fields: Version fields to retrieve
+        :param limit: Maximum number of versions to return, 0 for all of them
+        :param page: Page of limit sized results to return, starting at 1, 0 to not page
+        :returns: (sg_bundle_data, sg_versions) tuple where sg_bundle_data is the
+                  bundle entity dictionary, or None for core, and sg_versions is the
+                  list of version entity dictionaries.
+        :raises: TankDescriptorError if the play store doesn't contain the bundle.
+        """
+        order = [{"field_name": "created_at", "direction": "desc"}]
+
+        if self._bundle_type == self.CORE:
+            # core doesn't have a parent entity for its versions
+            sg_versions = self._sg_call(
+                sg.find,
+                self.CORE_VERSION_ENTITY_TYPE,
+                filters=filters,
+                fields=fields,
+                order=order,
+                limit=limit,
+                page=page,
+            )
+            return (None, sg_versions)
+
+        entity_type = self.playstore_version_entity_mapping[self._bundle_type]
+
+        # filter versions on the system name of the bundle they are linked to,
+        # rather than looking up the bundle entity first.
+        try:
+            sg_versions = self._sg_call(
+                sg.find,
+                entity_type,
+                filters=filters
+                + [[self._get_linked_bundle_field("sg_system_name"), "is", self._name]],
+                fields=list(fields) + self._get_linked_bundle_fields(),
+                order=order,
+                limit=limit,
+                page=page,
+            )
+        except shotgun_api3.Fault as e:
+            log.debug("Could not retrieve bundle and version data at once: %s" % e)
+            sg_versions = None
+
+        if sg_versions:
+            # all versions are linked to the same bundle
+            for sg_version in sg_versions:
+                sg_bundle_data = self._pop_linked_bundle_data(sg_version)
+            return (sg_bundle_data, sg_versions)
+
+        # either nothing matched or the query was rejected. Look the bundle up to
+        # find out if it exists and if needed, query its versions through it.
+        sg_bundle_data = self._sg_call(
+            sg.find_one,
+            self.playstore_entity_mapping[self._bundle_type],
+            [["sg_system_name", "is", self._name]],
+            self.bundle_fields_to_cache,
+        )
+
+        if sg_bundle_data is None:
+            raise TankDescriptorError(
+                "Play Store does not contain an item named '%s'!" % self._name
+            )
+
+        if sg_versions is None:
+            link_field = self.playstore_link_field_mapping[self._bundle_type]
+            sg_versions = self._sg_call(
+                sg.find,
+                entity_type,
+                filters=filters + [[link_field, "is", sg_bundle_data]],
+                fields=fields,
+                order=order,
+                limit=limit,
+                page=page,
+            )
+
+        return (sg_bundle_data, sg_versions)
+
     def _match_label(self, tag_list):
         """
         Given a list of tags, see if it matches the given label
@@ -743,9 +1365,17 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
             # no tags defined, so no match
             return False
 
-        # glob match each item
+        # glob match each item. This mirrors fnmatch.fnmatch, but the regular
+        # expression for each tag is only built once since the same tags are
+        # matched again for every version being considered.
+        label = os.path.normcase(self._label)
         for tag in tag_list:
-            if fnmatch.fnmatch(self._label, tag):
+            pattern = _tag_patterns.get(tag)
+            if pattern is None:
+                pattern = _tag_patterns[tag] = re.compile(
+                    fnmatch.translate(os.path.normcase(tag))
+                )
+            if pattern.match(label):
                 return True
 
         return False
@@ -757,6 +1387,41 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         key is found, than its value will be used. Note that if the ``play_store_http_proxy`` setting
         is set to ``null`` or an empty string in the configuration file, it means that the play store
         proxy is being forced to ``None`` and therefore won't be inherited from the http proxy setting.
+        The setting is only resolved once per client site.
+        :returns: The http proxy connection string.
+        """
+        key = self._get_proxy_cache_key()
+        try:
+            return self._play_store_proxies[key]
+        except KeyError:
+            proxy = self._play_store_proxies[key] = (
+                self._resolve_play_store_proxy_setting()
+            )
+            return proxy
+
+    def invalidate_proxy_cache(self):
+        """
+        Discards the play store proxy setting resolved for the client site,
+        so that it is looked up again the next time it is needed.
+        """
+        self._play_store_proxies.pop(self._get_proxy_cache_key(), None)
+
+    def _get_proxy_cache_key(self):
+        """
+        Returns the key of the proxy setting of this descriptor in
+        :attr:`_play_store_proxies`. Play stores read their proxy from
+        different settings, so they can't share the value for a site.
+        :returns: (play store url, proxy setting name, client site url) tuple
+        """
+        return (
+            self.SGTK_PLAY_STORE,
+            self.PLAY_STORE_HTTP_PROXY,
+            self._sg_connection.base_url,
+        )
+
+    def _resolve_play_store_proxy_setting(self):
+        """
+        Resolves the play store proxy settings. See :meth:`_get_play_store_proxy_setting`.
         :returns: The http proxy connection string.
         """
         try:
@@ -764,8 +1429,11 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         except UnresolvableCoreConfigurationError:
             config_data = None
 
-        if config_data and self.PLAY_STORE_HTTP_PROXY in config_data:
-            return config_data[self.PLAY_STORE_HTTP_PROXY]
+        if config_data:
+            # a None value forces the proxy to None, so it can't mark a missing key
+            proxy = config_data.get(self.PLAY_STORE_HTTP_PROXY, _UNSET)
+            if proxy is not _UNSET:
+                return proxy
 
         settings = UserSettings()
         if settings.play_store_proxy is not None:
@@ -776,26 +1444,132 @@ class IODescriptorPlayStoreBase(IODescriptorDownloadable):
         # will have been previously looked up to create the connection to Shotgun.
         return self._sg_connection.config.raw_http_proxy
 
-    def has_remote_access(self):
+    def has_remote_access(self, deep=False):
         """
         Probes if the current descriptor is able to handle
         remote requests. If this method returns, true, operations
         such as :meth:`download_local` and :meth:`get_latest_version`
         can be expected to succeed.
+        By default, once play store credentials have been established for
+        the client site and unless a proxy is used to reach the play store,
+        only checks that a connection can be opened to the play store host.
+        Otherwise, connects to the play store with the site's credentials.
+        :param deep: If True, always connect to the play store with the
+                     credentials provided by the site.
         :return: True if a remote is accessible, false if not.
         """
+        if self._is_play_store_access_disabled():
+            return False
+
+        # reuse a recent probe result of any descriptor for the same site rather
+        # than connecting again, as long as it is at least as thorough as the one
+        # requested.
+        probe_key = self._get_remote_access_probe_key()
+        last_probe = _remote_access_probes.get(probe_key)
+        if last_probe is not None:
+            (probed_at, probed_deep, can_connect) = last_probe
+            if (probed_deep or not deep) and (
+                time.time() - probed_at < REMOTE_ACCESS_PROBE_MAX_AGE
+            ):
+                return can_connect
+
+        # without credentials, the site must be checked as well as the play store.
+        # When going through a proxy, only the proxy knows if the play store is
+        # reachable.
+        deep = (
+            deep
+            or not self._has_play_store_credentials()
+            or bool(self._get_play_store_proxy_setting())
+        )
+        if deep:
+            # shotgun_api3 already retries requests failing transiently
+            can_connect = self._probe_play_store_connection()
+        else:
+            can_connect = self._probe_play_store_host()
+
+        _remote_access_probes[probe_key] = (time.time(), deep, can_connect)
+        return can_connect
+
+    def _has_recent_remote_access(self):
+        """
+        Tells whether a recent remote access probe for the client site,
+        made by any descriptor, found the play store accessible. No probe
+        is made by this method.
+        :return: True if the play store was recently accessible, false if not.
+        """
+        last_probe = _remote_access_probes.get(self._get_remote_access_probe_key())
+        if last_probe is None:
+            return False
+        (probed_at, _, can_connect) = last_probe
+        return can_connect and time.time() - probed_at < REMOTE_ACCESS_PROBE_MAX_AGE
+
+    def _has_play_store_credentials(self):
+        """
+        Tells whether credentials to connect to the play store have already
+        been established for the client site, so that remote operations only
+        depend on the play store being reachable.
+        :return: True if credentials are established, false if not.
+        """
+        return self._sg_connection.base_url in self._play_store_connections
+
+    def _probe_play_store_host(self):
+        """
+        Checks if a connection can be opened to the play store host. Failures
+        reported quickly, e.g. a connection reset, are retried after a short
+        delay. All attempts together take at most
+        :attr:`SGTK_PLAY_STORE_CONN_TIMEOUT` seconds.
+        :return: True if the host can be reached, false if not.
+        """
+        url = urllib.parse.urlparse(self.SGTK_PLAY_STORE)
+        port = url.port or (443 if url.scheme == "https" else 80)
+        log.debug(
+            "%r: Probing if the PlayStore host %s can be reached...",
+            self,
+            url.hostname,
+        )
+        deadline = time.time() + self.SGTK_PLAY_STORE_CONN_TIMEOUT
+        for attempt in range(REMOTE_ACCESS_PROBE_ATTEMPTS):
+            if attempt:
+                delay = 0.25 * attempt
+                if deadline - time.time() <= delay:
+                    break
+                time.sleep(delay)
+            try:
+                sock = socket.create_connection(
+                    (url.hostname, port), deadline - time.time()
+                )
+                sock.close()
+                log.debug("...host reached.")
+                return True
+            except socket.timeout as e:
+                # the attempts have used up their time
+                log.debug("...could not reach host: %s", e)
+                break
+            except Exception as e:
+                log.debug("...could not reach host: %s", e)
+        return False
 
+    def _probe_play_store_connection(self):
+        """
+        Checks if a connection to the play store can be established.
+        :return: True if the play store is accessible, false if not.
+        """
         # check if we can connect to Shotgun
         can_connect = True
         try:
             log.debug(
-                "%r: Probing if a connection to the PlayStore can be established..."
-                % self
+                "%r: Probing if a connection to the PlayStore can be established...",
+                self,
             )
-            # connect to the play store
-            (sg, _) = self._create_sg_play_store_connection()
-            log.debug("...connection established: %s" % sg)
+            # connect to the play store, or reuse the existing connection after
+            # checking the play store still accepts its credentials. Unlike info,
+            # find_one requests are authenticated.
+            (sg, script_user) = self._create_sg_play_store_connection()
+            sg.find_one("ApiUser", [["id", "is", script_user["id"]]], ["id"])
+            log.debug("...connection established: %s", sg)
         except Exception as e:
-            log.debug("...could not establish connection: %s" % e)
+            log.debug("...could not establish connection: %s", e)
+            # don't let other operations reuse a broken connection
+            self._discard_sg_play_store_connection()
             can_connect = False
-        return can_connect
\ No newline at end of file
+        return can_connect